@@ -1,16 +1,30 @@
 # app.py
 import os
+import re
 import time
 import json
 import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
+import nest_asyncio
+import numpy as np
+import pandas as pd
 import streamlit as st
 from dotenv import load_dotenv
 
 # External module from your project
-from hybrid_rag import setup_hybrid_rag, query_hybrid_rag
+from hybrid_rag import (
+    setup_hybrid_rag,
+    query_hybrid_rag_stream,
+    embed_query,
+    create_llm,
+    create_llama_cloud_index,
+    CITIES,
+)
 
 # -----------------------------------------------------------------------------
 # Page Config & Global Styles
@@ -23,9 +37,7 @@ st.set_page_config(
 )
 
 # ---- Global CSS (clean, modern, responsive) ----
-st.markdown(
-    """
-    <style>
+_RAW_CSS = """
     
       @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600;700;800&display=swap');
 
@@ -151,10 +163,18 @@ st.markdown(
       section[data-testid="stSidebar"] > div {
         background: linear-gradient(180deg, rgba(2,6,23,0.85), rgba(2,6,23,0.92));
       }
-    </style>
-    """,
-    unsafe_allow_html=True,
-)
+"""
+
+@st.cache_resource(show_spinner=False)
+def _global_css() -> str:
+    # Minify once per process (the script body re-runs on every interaction):
+    # drop comments, collapse whitespace, trim around punctuation.
+    css = re.sub(r"/\*.*?\*/", "", _RAW_CSS, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};:,>])\s*", r"\1", css).strip()
+    return f"<style>{css}</style>"
+
+st.markdown(_global_css(), unsafe_allow_html=True)
 
 # -----------------------------------------------------------------------------
 # Environment & Setup
@@ -169,7 +189,14 @@ REQUIRED_ENV = [
     "LLAMA_CLOUD_ORG_ID",
 ]
 
-missing_env = [k for k in REQUIRED_ENV if not os.getenv(k)]
+@st.cache_resource(show_spinner=False)
+def _env_status() -> Dict[str, bool]:
+    # Checked once per process; the setup help already asks for a restart
+    # after editing .env.
+    return {k: bool(os.getenv(k)) for k in REQUIRED_ENV}
+
+env_status = _env_status()
+missing_env = [k for k, present in env_status.items() if not present]
 
 assets_path = Path("assets")
 groq_logo_path = assets_path / "groq_logo.png"
@@ -231,25 +258,176 @@ if missing_env:
 # -----------------------------------------------------------------------------
 # Cached Setup & Session State
 # -----------------------------------------------------------------------------
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    # One long-lived loop, so HTTP clients bound to it keep their pooled
+    # (keep-alive) connections across reruns instead of being torn down
+    # by a fresh asyncio.run() per query. It runs forever on its own
+    # daemon thread: asyncio loops aren't thread-safe, and every session's
+    # script thread submits work to it via run_coroutine_threadsafe.
+    loop = asyncio.new_event_loop()
+    # Library code that nests run_until_complete on the loop thread itself
+    nest_asyncio.apply(loop)
+    threading.Thread(target=loop.run_forever, name="hybrid-rag-loop", daemon=True).start()
+    return loop
+
+def _run(coro):
+    # Run a coroutine on the shared loop and block this script thread on it
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+@st.cache_resource(show_spinner=False)
+def get_groq():
+    return create_llm()
+
+@st.cache_resource(show_spinner=False)
+def get_llama_cloud_index():
+    return create_llama_cloud_index()
+
 @st.cache_resource(show_spinner=False)
 def _init_workflow_sync():
     # Wrap the async initializer in a sync function and cache it.
-    return asyncio.run(setup_hybrid_rag())
+    # Clients are process-wide singletons, so reinitializing reuses them.
+    return _run(setup_hybrid_rag(llm=get_groq(), index=get_llama_cloud_index()))
 
 if "workflow" not in st.session_state:
     with st.spinner("Booting up the hybrid RAG pipeline…"):
         st.session_state.workflow = _init_workflow_sync()
 
+# Only the most recent messages are replayed on every rerun; the full
+# conversation is kept for the transcript download
+MAX_MESSAGES = 40
+
 if "messages" not in st.session_state:
     st.session_state.messages: List[Dict[str, str]] = []
 
+# Bumped whenever st.session_state.messages changes; keys the transcript bytes
+if "messages_rev" not in st.session_state:
+    st.session_state.messages_rev = 0
+
+# Per-query timings (query, ttft_ms, total_ms, chunks), newest last
+LATENCY_HISTORY_MAX = 200
+
+if "latencies" not in st.session_state:
+    st.session_state.latencies: List[Dict[str, Any]] = []
+
+# Exact-match response cache (key -> normalized payload), shared by all
+# sessions. Filled after a streamed answer completes; st.cache_data would
+# compute on a miss inside the cached call and block the token stream.
+# The agent answers in the context of the conversation, so only a session's
+# first question is keyed on the query alone; follow-ups ("What about
+# Chicago?") are keyed on a digest of the conversation so far as well.
+RESPONSE_CACHE_TTL = 3600
+RESPONSE_CACHE_MAX_ENTRIES = 512
+
+# Semantic cache: reuse an answer when a paraphrased query's embedding is
+# close enough (cosine) to one already answered in this session, and it
+# names the same cities and asks for the same extreme (highest vs lowest).
+# At most SEMANTIC_CACHE_MAX_ENTRIES are kept; the oldest is overwritten
+# first. Raise the threshold if unrelated questions get
+# matched, lower it to catch looser paraphrases; bge-small scores cluster
+# high, so values much below 0.9 produce false hits.
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.93"))
+SEMANTIC_CACHE_MAX_ENTRIES = 256
+
+def _new_sem_cache() -> Dict[str, Any]:
+    # "emb" is preallocated to the cap on first insert and filled in place
+    return {"emb": None, "answers": [], "entities": [], "next": 0}
+
+if "sem_cache" not in st.session_state:
+    st.session_state.sem_cache = _new_sem_cache()
+
+@st.cache_resource(show_spinner=False)
+def _response_cache() -> "OrderedDict[str, Tuple[float, Dict[str, Any]]]":
+    return OrderedDict()
+
+@st.cache_resource(show_spinner=False)
+def _response_cache_lock() -> threading.Lock:
+    # Every session thread reads and evicts from the same OrderedDict
+    return threading.Lock()
+
 # -----------------------------------------------------------------------------
 # Utilities
 # -----------------------------------------------------------------------------
+_WS_RE = re.compile(r"\s+")
+# Escapes text placed inside bubble divs (rendered with unsafe_allow_html)
+_ESC = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+# Lowercased city name/alias -> canonical key, matched on normalized queries
+_CITY_ALIASES = {c.lower().removesuffix(" city"): c.lower() for c in CITIES}
+_CITY_ALIASES["nyc"] = "new york city"
+_CITY_RE = re.compile(
+    r"\b(" + "|".join(map(re.escape, sorted(_CITY_ALIASES, key=len, reverse=True))) + r")\b"
+)
+_WORD_RE = re.compile(r"[a-z]+")
+# Opposite superlatives embed close together but need different answers
+_MAX_WORDS = frozenset({"highest", "largest", "biggest", "most", "greatest", "maximum", "top"})
+_MIN_WORDS = frozenset({"lowest", "smallest", "least", "fewest", "minimum"})
+_ANSWER_KEYS = ("answer", "result")
+_KEEP = ("sources", "sql", "rows")
+
+def _aiter_to_sync(agen):
+    # Pump an async iterator on the shared loop one item at a time, so
+    # st.write_stream can render each chunk as soon as it arrives.
+    # Always close it, so a rerun mid-stream doesn't leave it half-run.
+    try:
+        while True:
+            try:
+                yield _run(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        _run(agen.aclose())
+
+def _timed(chunks, stats: Dict[str, Any]):
+    # Record when the first chunk arrives and how many chunks were streamed
+    for chunk in chunks:
+        if "first_chunk_at" not in stats:
+            stats["first_chunk_at"] = time.perf_counter()
+        stats["chunks"] = stats.get("chunks", 0) + 1
+        yield chunk
+
+def _record_latency(query_text: str, start: float, stats: Dict[str, Any]):
+    end = time.perf_counter()
+    latencies = st.session_state.latencies
+    latencies.append({
+        "query": query_text,
+        "ttft_ms": (stats.get("first_chunk_at", end) - start) * 1000,
+        "total_ms": (end - start) * 1000,
+        "chunks": stats.get("chunks", 0),
+    })
+    del latencies[:-LATENCY_HISTORY_MAX]
+
 def _render_message(role: str, content: str, avatar: str = ""):
     cls = "bubble-assistant" if role == "assistant" else "bubble-user"
     with st.chat_message(role, avatar=avatar):
-        st.markdown(f"<div class='bubble {cls}'>{content}</div>", unsafe_allow_html=True)
+        st.markdown(f"<div class='bubble {cls}'>{content.translate(_ESC)}</div>", unsafe_allow_html=True)
+
+def _render_history(messages: List[Dict[str, str]]):
+    # Past turns go out as one HTML blob (a single element) instead of a
+    # chat_message + markdown pair per turn, keeping rerun diffs small.
+    if not messages:
+        return
+    html = "\n".join(
+        f"<div class='bubble bubble-{m['role']}'>{m['content'].translate(_ESC)}</div>"
+        for m in messages
+    )
+    st.markdown(html, unsafe_allow_html=True)
+
+def _build_transcript(msgs: List[Dict[str, str]]) -> bytes:
+    # Rebuilt only when the messages revision changes; the bytes are kept per
+    # session (never in a process-wide cache, which would let sessions with
+    # similar-looking conversations download each other's transcripts).
+    rev = st.session_state.messages_rev
+    cached = st.session_state.get("transcript")
+    if cached is not None and cached[0] == rev:
+        return cached[1]
+
+    transcript_md = []
+    for m in msgs:
+        prefix = "**You:**" if m["role"] == "user" else "**Assistant:**"
+        transcript_md.append(f"{prefix}\n\n{m['content']}\n")
+    blob = "\n---\n".join(transcript_md).encode("utf-8")
+    st.session_state.transcript = (rev, blob)
+    return blob
 
 def _normalize_result(result: Any) -> Dict[str, Any]:
     """
@@ -261,17 +439,96 @@ def _normalize_result(result: Any) -> Dict[str, Any]:
         return {"answer": result}
     if isinstance(result, dict):
         # Keep known fields only; avoid leaking unexpected objects
-        normalized = {"answer": result.get("answer") or result.get("result") or ""}
-        if "sources" in result and isinstance(result["sources"], list):
-            normalized["sources"] = result["sources"]
-        if "sql" in result:
-            normalized["sql"] = result["sql"]
-        if "rows" in result:
-            normalized["rows"] = result["rows"]
+        normalized = {"answer": next((result[k] for k in _ANSWER_KEYS if result.get(k)), "")}
+        normalized.update({k: result[k] for k in _KEEP if k in result and result[k]})
+        if not isinstance(normalized.get("sources", []), list):
+            del normalized["sources"]
         return normalized
     # Fallback
     return {"answer": str(result)}
 
+def _normalize_query(query_text: str) -> str:
+    return _WS_RE.sub(" ", query_text.strip().lower())
+
+def _response_cache_key(q_norm: str, history: List[Dict[str, str]]) -> str:
+    if not history:
+        return q_norm
+    h = hashlib.blake2b(digest_size=16)
+    for m in history:
+        h.update(f"{m['role']}\0{m['content']}\0".encode("utf-8"))
+    return f"{h.hexdigest()}:{q_norm}"
+
+def _cache_get(key: str) -> Optional[Dict[str, Any]]:
+    cache = _response_cache()
+    with _response_cache_lock():
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        stored_at, payload = entry
+        if time.time() - stored_at > RESPONSE_CACHE_TTL:
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return payload
+
+def _cache_put(key: str, payload: Dict[str, Any]):
+    cache = _response_cache()
+    with _response_cache_lock():
+        cache[key] = (time.time(), payload)
+        cache.move_to_end(key)
+        # Evict least recently used entries beyond the cap
+        while len(cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+def _embed_unit(query_text: str) -> np.ndarray:
+    v = np.asarray(embed_query(query_text), dtype=np.float32)
+    norm = np.linalg.norm(v)
+    return v / norm if norm else v
+
+def _query_entities(q_norm: str) -> frozenset:
+    # What a semantic hit must share with the query: the cities it names
+    # ("houston" vs "miami") and which extreme it asks for
+    entities = {_CITY_ALIASES[m] for m in _CITY_RE.findall(q_norm)}
+    words = set(_WORD_RE.findall(q_norm))
+    if words & _MAX_WORDS:
+        entities.add("<max>")
+    if words & _MIN_WORDS:
+        entities.add("<min>")
+    return frozenset(entities)
+
+def _sem_cache_get(v: np.ndarray, entities: frozenset) -> Optional[Dict[str, Any]]:
+    cache = st.session_state.sem_cache
+    # Rows are unit vectors, so one matmul gives every cosine score
+    scores = cache["emb"][:len(cache["answers"])] @ v
+    for i in np.argsort(scores)[::-1]:
+        if scores[i] < SEMANTIC_CACHE_THRESHOLD:
+            break
+        if cache["entities"][i] == entities:
+            return cache["answers"][i]
+    return None
+
+def _sem_cache_put(v: np.ndarray, entities: frozenset, payload: Dict[str, Any]):
+    cache = st.session_state.sem_cache
+    if cache["emb"] is None:
+        cache["emb"] = np.empty((SEMANTIC_CACHE_MAX_ENTRIES, v.shape[0]), dtype=np.float32)
+    # Ring buffer: append until full, then overwrite the oldest slot
+    i = cache["next"] % SEMANTIC_CACHE_MAX_ENTRIES
+    cache["emb"][i] = v
+    if i == len(cache["answers"]):
+        cache["answers"].append(payload)
+        cache["entities"].append(entities)
+    else:
+        cache["answers"][i] = payload
+        cache["entities"][i] = entities
+    cache["next"] += 1
+
+@st.cache_data(show_spinner=False)
+def _rows_to_df(rows: Any) -> pd.DataFrame:
+    # st.cache_data hashes the rows itself, so column order and SQL types
+    # (Decimal, date, ...) survive; Arrow-backed dtypes keep the hand-off to
+    # the frontend's Arrow bridge cheap
+    return pd.DataFrame(rows).convert_dtypes(dtype_backend="pyarrow")
+
 def _render_rich_answer(payload: Dict[str, Any]):
     # Main answer
     st.markdown(payload.get("answer", ""))
@@ -286,8 +543,7 @@ def _render_rich_answer(payload: Dict[str, Any]):
         with st.expander("Structured results"):
             # Try a pretty table if rows look tabular
             try:
-                import pandas as pd
-                df = pd.DataFrame(payload["rows"])
+                df = _rows_to_df(payload["rows"])
                 st.dataframe(df, use_container_width=True, hide_index=True)
             except Exception:
                 st.write(payload["rows"])
@@ -308,28 +564,70 @@ def _render_rich_answer(payload: Dict[str, Any]):
                     st.markdown(f"> {snippet}")
 
 def _process_query(query_text: str):
+    # Cache key depends on the conversation before this question
+    q_norm = _normalize_query(query_text)
+    cache_key = _response_cache_key(q_norm, st.session_state.messages)
+
     # Append & display user
     st.session_state.messages.append({"role": "user", "content": query_text})
+    st.session_state.messages_rev += 1
     _render_message("user", query_text, avatar="🧑‍💻")
 
     # Call pipeline
-    start = time.time()
+    start = time.perf_counter()
+    stats: Dict[str, Any] = {}
     with st.chat_message("assistant", avatar="🤖"):
         with st.spinner("Thinking…"):
             try:
-                raw = asyncio.run(query_hybrid_rag(st.session_state.workflow, query_text))
-                payload = _normalize_result(raw)
-                _render_rich_answer(payload)
+                q_vec = None
+                q_entities = _query_entities(q_norm)
+                payload = _cache_get(cache_key)
+                if payload is None and st.session_state.sem_cache["answers"]:
+                    # Exact miss: try a paraphrase match before the pipeline.
+                    # Semantic hits stay session-local; they never seed the
+                    # shared exact-match cache.
+                    q_vec = _embed_unit(q_norm)
+                    payload = _sem_cache_get(q_vec, q_entities)
+                if payload is not None:
+                    # Cache hit: skip retrieval + generation entirely, but keep
+                    # the agent's history in step for later follow-ups
+                    _render_rich_answer(payload)
+                    st.session_state.workflow.record_turn(query_text, payload.get("answer", ""))
+                else:
+                    outcome: Dict[str, Any] = {}
+                    stream = query_hybrid_rag_stream(st.session_state.workflow, query_text, outcome)
+                    pump = _aiter_to_sync(stream)
+                    answer_slot = st.empty()
+                    try:
+                        answer_slot.write_stream(_timed(pump, stats))
+                    finally:
+                        # Runs the pump's cleanup now if write_stream was interrupted
+                        pump.close()
+                    # The workflow's result is the answer; the streamed text may
+                    # include preamble the model wrote before calling tools.
+                    # Failures raise out of the stream, so only complete runs get here.
+                    payload = _normalize_result(outcome.get("result") or "")
+                    answer_slot.markdown(payload["answer"])
+                    if payload["answer"]:
+                        _cache_put(cache_key, payload)
+                        if q_vec is None:
+                            q_vec = _embed_unit(q_norm)
+                        _sem_cache_put(q_vec, q_entities, payload)
                 answer_text = payload.get("answer", "")
             except Exception as e:
                 st.error(f"Error during query: {e}")
                 answer_text = "Sorry, something went wrong while processing your query."
 
-            elapsed = time.time() - start
-            st.caption(f"Responded in {elapsed:.2f}s")
+            _record_latency(query_text, start, stats)
+            timing = st.session_state.latencies[-1]
+            st.caption(
+                f"Responded in {timing['total_ms'] / 1000:.2f}s "
+                f"(first token after {timing['ttft_ms'] / 1000:.2f}s)"
+            )
 
     # Store assistant message for future render
     st.session_state.messages.append({"role": "assistant", "content": answer_text})
+    st.session_state.messages_rev += 1
 
 # -----------------------------------------------------------------------------
 # Prompt Chips
@@ -344,11 +642,15 @@ EXAMPLE_QUERIES = [
 ]
 
 
+# Set when a chip answered inline this run; that turn is already on screen
+just_answered = False
+
 chips_cols = st.columns(3)
 for idx, q in enumerate(EXAMPLE_QUERIES):
     with chips_cols[idx % 3]:
         if st.button(q, use_container_width=True):
             _process_query(q)
+            just_answered = True
 st.markdown("</div>", unsafe_allow_html=True)
 
 st.markdown("<br/>", unsafe_allow_html=True)
@@ -357,12 +659,13 @@ st.markdown("<br/>", unsafe_allow_html=True)
 # Conversation (History Render)
 # -----------------------------------------------------------------------------
 # Replay chat history (so redesigned bubbles persist across reruns)
-for m in st.session_state.messages:
-    _render_message(
-        m["role"],
-        m["content"],
-        avatar=("🧑‍💻" if m["role"] == "user" else "🤖")
+# (skipping the user+assistant pair a chip just drew above)
+history = st.session_state.messages[:-2 if just_answered else None]
+if len(history) > MAX_MESSAGES:
+    st.caption(
+        f"Showing the last {MAX_MESSAGES} messages; the transcript download has the full conversation."
     )
+_render_history(history[-MAX_MESSAGES:])
 
 # -----------------------------------------------------------------------------
 # Chat Input
@@ -379,8 +682,12 @@ with st.sidebar:
     st.markdown("### Status")
     ok = "✅"
     bad = "❌"
-    for k in REQUIRED_ENV:
-        st.write(f"{ok if os.getenv(k) else bad} `{k}`")
+    st.markdown("  \n".join(f"{ok if present else bad} `{k}`" for k, present in env_status.items()))
+
+    if st.session_state.latencies:
+        st.divider()
+        st.markdown("### Latency (ms)")
+        st.line_chart(pd.DataFrame(st.session_state.latencies)[["ttft_ms", "total_ms"]])
 
     st.divider()
     st.markdown("### Quick Actions")
@@ -388,10 +695,14 @@ with st.sidebar:
     with col_a:
         if st.button("Clear Chat"):
             st.session_state.messages = []
+            st.session_state.messages_rev += 1
+            st.session_state.sem_cache = _new_sem_cache()
             st.rerun()
     with col_b:
         if st.button("Reinitialize"):
-            # Clear cached setup and reinit
+            # Clear cached setup and reinit on the shared loop. The old
+            # workflow isn't closed: other sessions may still be using it, and
+            # its clients are the cached singletons the new one reuses.
             _init_workflow_sync.clear()
             try:
                 with st.spinner("Reinitializing pipeline…"):
@@ -402,15 +713,11 @@ with st.sidebar:
     st.divider()
     st.markdown("### Download")
     # Export transcript (simple Markdown)
-    if st.session_state.messages:
-        transcript_md = []
-        for m in st.session_state.messages:
-            prefix = "**You:**" if m["role"] == "user" else "**Assistant:**"
-            transcript_md.append(f"{prefix}\n\n{m['content']}\n")
-        md_blob = "\n---\n".join(transcript_md)
+    msgs = st.session_state.messages
+    if msgs:
         st.download_button(
             label="Download Transcript (.md)",
-            data=md_blob.encode("utf-8"),
+            data=_build_transcript(msgs),
             file_name="hybrid_rag_transcript.md",
             mime="text/markdown",
             use_container_width=True
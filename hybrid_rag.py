@@ -1,6 +1,10 @@
 import os
+import re
+import json
+import time
+import hashlib
 import nest_asyncio
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 from dotenv import load_dotenv
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 from sqlalchemy import (
@@ -18,6 +22,8 @@ from llama_index.core import SQLDatabase, Settings
 from llama_index.core.tools import BaseTool, QueryEngineTool
 from llama_index.core.llms import ChatMessage
 from llama_index.core.llms.llm import ToolSelection, LLM
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import NodeWithScore, QueryBundle
 from llama_index.core.workflow import (
     Workflow,
     Event,
@@ -47,6 +53,46 @@ load_dotenv()
 # - LLAMA_CLOUD_ORG_ID: Your LlamaCloud organization ID
 
 
+# Cities covered by the SQL table and the LlamaCloud documents
+CITIES = ["New York City", "Los Angeles", "Chicago", "Houston", "Miami", "Seattle"]
+
+# Number of texts embedded per model forward pass
+EMBED_BATCH_SIZE = 128
+
+# Kept byte-identical across turns so the provider can reuse its prefix (KV) cache
+SYSTEM_PROMPT = (
+    "You are a helpful assistant answering questions about cities in the USA. "
+    "Use sql_tool for population and state facts, and llama_cloud_tool for "
+    "everything else about the cities."
+)
+
+
+def prefix_digest(messages: List[ChatMessage]) -> str:
+    """Short digest of a message prefix, used to verify it stays stable across turns"""
+    h = hashlib.blake2b(digest_size=8)
+    for message in messages:
+        h.update(f"{message.role}:{message.content}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def tool_cache_key(tool_name: str, tool_kwargs: Dict[str, Any]) -> str:
+    """Cache key for a tool call, insensitive to case/whitespace in string arguments"""
+    normalized = {
+        k: re.sub(r"\s+", " ", v.strip().lower()) if isinstance(v, str) else v
+        for k, v in tool_kwargs.items()
+    }
+    return f"{tool_name}:{json.dumps(normalized, sort_keys=True, default=str)}"
+
+
+class CanonicalOrderPostprocessor(BaseNodePostprocessor):
+    """Orders retrieved chunks by node ID so the same hits always build the same context block."""
+
+    def _postprocess_nodes(
+        self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None
+    ) -> List[NodeWithScore]:
+        return sorted(nodes, key=lambda n: n.node.node_id)
+
+
 class InputEvent(Event):
     """Input event."""
 
@@ -69,6 +115,12 @@ class ToolCallEventResult(Event):
     msg: ChatMessage
 
 
+class TokenEvent(Event):
+    """Streamed answer token."""
+
+    delta: str
+
+
 class RouterOutputAgentWorkflow(Workflow):
     """Custom router output agent workflow."""
 
@@ -80,6 +132,8 @@ class RouterOutputAgentWorkflow(Workflow):
         verbose: bool = False,
         llm: Optional[LLM] = None,
         chat_history: Optional[List[ChatMessage]] = None,
+        tool_cache_ttl: Optional[float] = 600.0,
+        max_history: Optional[int] = 40,
     ):
         """Constructor."""
 
@@ -97,10 +151,79 @@ class RouterOutputAgentWorkflow(Workflow):
  
 
         self.chat_history: List[ChatMessage] = chat_history or []
+        if not self.chat_history or self.chat_history[0].role != "system":
+            self.chat_history.insert(0, ChatMessage(role="system", content=SYSTEM_PROMPT))
+
+        # Retrieval-only cache: tool outputs are reused for tool_cache_ttl
+        # seconds, while the answer itself is always regenerated.
+        self.tool_cache_ttl: Optional[float] = tool_cache_ttl
+        self._tool_cache: Dict[str, Tuple[float, str]] = {}
+
+        # Older turns beyond max_history messages are folded into a summary
+        self.max_history: Optional[int] = max_history
 
     def reset(self) -> None:
         """Resets Chat History"""
-        self.chat_history = []
+        self.chat_history = [ChatMessage(role="system", content=SYSTEM_PROMPT)]
+
+    def record_turn(self, message: str, answer: str) -> None:
+        """Appends a turn answered without running the workflow (e.g. from a cache)."""
+        self.chat_history.append(ChatMessage(role="user", content=message))
+        self.chat_history.append(ChatMessage(role="assistant", content=answer))
+
+    def _cached_tool_output(self, tool_call: ToolSelection) -> Optional[str]:
+        """Returns a cached tool output if one is still fresh."""
+        if not self.tool_cache_ttl:
+            return None
+        key = tool_cache_key(tool_call.tool_name, tool_call.tool_kwargs)
+        entry = self._tool_cache.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.tool_cache_ttl:
+            return None
+        if self._verbose:
+            print(f"Reusing cached output for {tool_call.tool_name}")
+        return entry[1]
+
+    def _store_tool_output(self, tool_call: ToolSelection, content: str) -> None:
+        """Stores a tool output, dropping expired entries."""
+        if not self.tool_cache_ttl:
+            return
+        now = time.monotonic()
+        self._tool_cache = {
+            k: v for k, v in self._tool_cache.items() if now - v[0] <= self.tool_cache_ttl
+        }
+        key = tool_cache_key(tool_call.tool_name, tool_call.tool_kwargs)
+        self._tool_cache[key] = (now, content)
+
+    async def _compact_history(self) -> None:
+        """Summarizes older turns once the history grows past max_history."""
+        if not self.max_history or len(self.chat_history) <= self.max_history:
+            return
+
+        # Keep the system prompt, and cut on a user message so tool calls
+        # stay with their results; keep half the budget to summarize rarely.
+        system, turns = self.chat_history[:1], self.chat_history[1:]
+        keep = self.max_history // 2
+        cut = next(
+            (
+                i
+                for i, m in enumerate(turns)
+                if i > 0 and m.role == "user" and len(turns) - i <= keep
+            ),
+            None,
+        )
+        if cut is None:
+            return
+
+        transcript = "\n".join(
+            f"{m.role.value}: {m.content}" for m in turns[:cut] if m.content
+        )
+        summary = await self.llm.acomplete(
+            "Summarize this conversation in a few sentences, keeping any facts "
+            "a follow-up question may refer to:\n\n" + transcript
+        )
+        self.chat_history = system + [
+            ChatMessage(role="system", content=f"Earlier conversation summary: {summary.text}")
+        ] + turns[cut:]
 
     @step()
     async def prepare_chat(self, ev: StartEvent) -> InputEvent:
@@ -108,22 +231,45 @@ class RouterOutputAgentWorkflow(Workflow):
         if message is None:
             raise ValueError("'message' field is required.")
 
-        # add msg to chat history
+        # add msg to chat history; history is append-only so every earlier
+        # turn stays a byte-identical prompt prefix
+        await self._compact_history()
         chat_history = self.chat_history
+        if self._verbose:
+            print(f"Prompt prefix digest: {prefix_digest(chat_history)}")
         chat_history.append(ChatMessage(role="user", content=message))
         return InputEvent()
 
-    @step()
-    async def chat(self, ev: InputEvent) -> GatherToolsEvent | StopEvent:
+    @step(pass_context=True)
+    async def chat(self, ctx: Context, ev: InputEvent) -> GatherToolsEvent | StopEvent:
         """Appends msg to chat history, then gets tool calls."""
 
-        # Put msg into LLM with tools included
-        chat_res = await self.llm.achat_with_tools(
+        # Put msg into LLM with tools included, streaming tokens as they arrive
+        response_stream = await self.llm.astream_chat_with_tools(
             self.tools,
             chat_history=self.chat_history,
             verbose=self._verbose,
             allow_parallel_tool_calls=True,
         )
+        chat_res = None
+        streamed = False
+        async for chat_res in response_stream:
+            # Text that accompanies tool calls is not part of the answer; once
+            # tool calls start arriving, stop streaming this response.
+            if not chat_res.delta or chat_res.message.additional_kwargs.get("tool_calls"):
+                continue
+            # Keep text from an earlier response in this run from running
+            # straight into this one
+            if not streamed and await ctx.get("streamed_answer", default=False):
+                ctx.write_event_to_stream(TokenEvent(delta="\n\n"))
+            ctx.write_event_to_stream(TokenEvent(delta=chat_res.delta))
+            streamed = True
+
+        if chat_res is None:
+            raise ValueError("LLM returned an empty response stream.")
+        if streamed:
+            await ctx.set("streamed_answer", True)
+
         tool_calls = self.llm.get_tool_calls_from_response(
             chat_res, error_on_no_tool_call=False
         )
@@ -152,7 +298,9 @@ class RouterOutputAgentWorkflow(Workflow):
 
         return None
 
-    @step()
+    # Several workers so SQL and document retrieval calls issued in the
+    # same turn run concurrently instead of one after the other.
+    @step(num_workers=4)
     async def call_tool(self, ev: ToolCallEvent) -> ToolCallEventResult:
         """Calls tool."""
 
@@ -166,12 +314,17 @@ class RouterOutputAgentWorkflow(Workflow):
                 f"Calling function {tool_call.tool_name} with msg {tool_call.tool_kwargs}"
             )
 
-        # call function and put result into a chat message
-        tool = self.tools_dict[tool_call.tool_name]
-        output = await tool.acall(**tool_call.tool_kwargs)
+        # call function (or reuse a recent identical call) and put result into a chat message
+        content = self._cached_tool_output(tool_call)
+        if content is None:
+            tool = self.tools_dict[tool_call.tool_name]
+            output = await tool.acall(**tool_call.tool_kwargs)
+            content = str(output)
+            if not getattr(output, "is_error", False):
+                self._store_tool_output(tool_call, content)
         msg = ChatMessage(
             name=tool_call.tool_name,
-            content=str(output),
+            content=content,
             role="tool",
             additional_kwargs={"tool_call_id": id_, "name": tool_call.tool_name},
         )
@@ -212,33 +365,17 @@ def create_sql_database(db_path="city_stats.db"):
     return engine, table_name
 
 
-async def setup_hybrid_rag():
-    """Setup the hybrid RAG system with SQL and LlamaCloud components"""
-    # Set up the LLM (Groq)
+def create_llm():
+    """Create the Groq LLM client"""
     groq_api_key = os.getenv("GROQ_API_KEY")
     if not groq_api_key:
         raise ValueError("GROQ_API_KEY environment variable is required")
 
-    llm = Groq(api_key=groq_api_key, model="llama-3.3-70b-versatile")
-
-
+    return Groq(api_key=groq_api_key, model="llama-3.3-70b-versatile")
 
 
-    Settings.llm = llm
-    embed_model = HuggingFaceEmbedding(
-        model_name="baai/bge-small-en-v1.5",
-        token=os.getenv("HUGGINGFACE_API_KEY"),
-    )
-    Settings.embed_model = embed_model
-
-    # Load the SQL database from file
-    engine, table_name = create_sql_database(db_path="city_stats.db")
-    sql_database = SQLDatabase(engine, include_tables=[table_name])
-    sql_query_engine = NLSQLTableQueryEngine(
-        sql_database=sql_database, tables=[table_name]
-    )
-
-    # Create LlamaCloud query engine
+def create_llama_cloud_index():
+    """Connect to the LlamaCloud index holding the city documents"""
     llama_cloud_api_key = os.getenv("LLAMA_CLOUD_API_KEY")
     llama_cloud_index_name = os.getenv("LLAMA_CLOUD_INDEX_NAME")
     llama_cloud_project_name = os.getenv("LLAMA_CLOUD_PROJECT_NAME")
@@ -254,14 +391,44 @@ async def setup_hybrid_rag():
     ):
         raise ValueError("All LlamaCloud environment variables are required")
 
-    index = LlamaCloudIndex(
+    return LlamaCloudIndex(
         name=llama_cloud_index_name,
         project_name=llama_cloud_project_name,
         organization_id=llama_cloud_org_id,
         api_key=llama_cloud_api_key,
     )
 
-    llama_cloud_query_engine = index.as_query_engine()
+
+async def setup_hybrid_rag(llm: Optional[LLM] = None, index: Optional[LlamaCloudIndex] = None):
+    """Setup the hybrid RAG system with SQL and LlamaCloud components
+
+    Pass ``llm`` and ``index`` to reuse existing clients; otherwise new ones are created.
+    """
+    # Set up the LLM (Groq)
+    llm = llm or create_llm()
+
+    Settings.llm = llm
+    embed_model = HuggingFaceEmbedding(
+        model_name="baai/bge-small-en-v1.5",
+        token=os.getenv("HUGGINGFACE_API_KEY"),
+        # Embed texts in large batches rather than the default of 10
+        embed_batch_size=EMBED_BATCH_SIZE,
+    )
+    Settings.embed_model = embed_model
+
+    # Load the SQL database from file
+    engine, table_name = create_sql_database(db_path="city_stats.db")
+    sql_database = SQLDatabase(engine, include_tables=[table_name])
+    sql_query_engine = NLSQLTableQueryEngine(
+        sql_database=sql_database, tables=[table_name]
+    )
+
+    # Create LlamaCloud query engine
+    index = index or create_llama_cloud_index()
+
+    llama_cloud_query_engine = index.as_query_engine(
+        node_postprocessors=[CanonicalOrderPostprocessor()]
+    )
 
     # Create query engine tools
     sql_tool = QueryEngineTool.from_defaults(
@@ -274,7 +441,6 @@ async def setup_hybrid_rag():
         name="sql_tool",
     )
 
-    cities = ["New York City", "Los Angeles", "Chicago", "Houston", "Miami", "Seattle"]
     llama_cloud_tool = QueryEngineTool.from_defaults(
         query_engine=llama_cloud_query_engine,
         description=(
@@ -291,6 +457,11 @@ async def setup_hybrid_rag():
     return wf
 
 
+def embed_query(query):
+    """Embed a query with the same model configured for retrieval"""
+    return Settings.embed_model.get_query_embedding(query)
+
+
 async def query_hybrid_rag(workflow, query):
     """Run a query through the hybrid RAG system"""
     try:
@@ -301,3 +472,31 @@ async def query_hybrid_rag(workflow, query):
         # Handle any exceptions during the workflow execution
         error_message = f"Error processing query: {str(e)}"
         return error_message
+
+
+async def query_hybrid_rag_stream(workflow, query, outcome: Optional[Dict[str, Any]] = None):
+    """Run a query through the hybrid RAG system, yielding answer tokens as they arrive
+
+    Unlike query_hybrid_rag, errors are raised rather than returned as text,
+    so callers can tell a failed (possibly partially streamed) answer apart.
+    Streamed tokens are for display only; once the run finishes, its final
+    result is stored in ``outcome["result"]`` when ``outcome`` is given.
+    """
+    handler = workflow.run(message=query)
+    try:
+        async for ev in handler.stream_events():
+            if isinstance(ev, TokenEvent):
+                yield ev.delta
+        # Surface any error raised after the last streamed token
+        result = await handler
+        if outcome is not None:
+            outcome["result"] = result
+    finally:
+        # Closed early (e.g. the UI abandoned the stream): stop the run so it
+        # doesn't finish in the background and append a turn to chat history
+        if not handler.done():
+            cancel_run = getattr(handler, "cancel_run", None)
+            if cancel_run is not None:
+                await cancel_run()
+            else:
+                handler.cancel()
@@ -1,5 +1,6 @@
 from groq import Groq
 import os
+import functools
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -8,6 +9,12 @@ load_dotenv()
 # Initialize client
 client = Groq(api_key=os.getenv("GROQ_API_KEY"))
 
-# List models
-models = client.models.list()
-print(models)
+
+@functools.lru_cache(maxsize=None)
+def list_models():
+    # Fetched on first call only, then reused for the rest of the process
+    return client.models.list()
+
+
+if __name__ == "__main__":
+    print(list_models())